@@ -0,0 +1,12 @@
+from math import atan2, degrees
+from numba import njit
+
+# Kept out of app.py: Streamlit re-executes the script as a fresh __main__ on
+# every rerun, while this module stays in sys.modules with its compiled dispatcher.
+@njit(cache=True)
+def angle_between_lines(a1x, a1y, a2x, a2y, b1x, b1y, b2x, b2y):
+    angle_deg = degrees(atan2(b2y - b1y, b2x - b1x) - atan2(a2y - a1y, a2x - a1x))
+    angle_deg = abs(angle_deg)
+    if angle_deg > 180:
+        angle_deg = 360 - angle_deg
+    return angle_deg
@@ -1,89 +1,176 @@
 import streamlit as st
 import cv2
 import numpy as np
-from math import atan2, degrees
 from PIL import Image
-import matplotlib.pyplot as plt
-
-def angle_between_lines(a1, a2, b1, b2):
-    v1 = a2 - a1
-    v2 = b2 - b1
-    angle_rad = np.arctan2(v2[1], v2[0]) - np.arctan2(v1[1], v1[0])
-    angle_deg = np.degrees(angle_rad)
-    angle_deg = np.abs(angle_deg)
-    if angle_deg > 180:
-        angle_deg = 360 - angle_deg
-    return angle_deg
+from io import BytesIO
+from angles import angle_between_lines
 
-def main():
-    st.title("📐 X-ray Angle Measurement Tool")
-    st.write("Upload a full-length lower limb X-ray to measure orthopedic angles")
+POINT_NAMES = [
+    'hip_center',
+    'femoral_condyles_center',
+    'medial_condyle',
+    'lateral_condyle',
+    'medial_tibial_plateau',
+    'lateral_tibial_plateau',
+    'tibia_center',
+    'ankle_center'
+]
+HC, FC, MC, LC, MTP, LTP, TC, AC = range(len(POINT_NAMES))
 
-    uploaded_file = st.file_uploader("Choose an X-ray image...", type=["jpg", "jpeg", "png"])
+@st.cache_data(max_entries=4)
+def _decode(file_bytes):
+    return np.asarray(Image.open(BytesIO(file_bytes)))
 
-    if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        img_array = np.array(image)
-        
-        # Add image orientation controls
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            flip_horizontal = st.checkbox("Flip Horizontal (Mirror)")
-        with col2:
-            flip_vertical = st.checkbox("Flip Vertical (Upside Down)")
-        with col3:
-            rotate_90 = st.checkbox("Rotate 90°")
-        
-        # Apply transformations
-        if flip_horizontal:
-            img_array = np.fliplr(img_array)
-        if flip_vertical:
-            img_array = np.flipud(img_array)
-        if rotate_90:
-            img_array = np.rot90(img_array)
-        
-        height, width = img_array.shape[0], img_array.shape[1]
-        
-        if 'points' not in st.session_state:
-            st.session_state.points = {
-                'hip_center': None,
-                'femoral_condyles_center': None,
-                'medial_condyle': None,
-                'lateral_condyle': None,
-                'medial_tibial_plateau': None,
-                'lateral_tibial_plateau': None,
-                'tibia_center': None,
-                'ankle_center': None
-            }
-            st.session_state.current_point = 0
-            st.session_state.original_image = img_array.copy()
+def build_affine(flip_horizontal, flip_vertical, rotate_90, w, h):
+    # Original -> displayed coordinates as [x', y'] = M @ [x, y] + t
+    M = np.eye(2, dtype=int)
+    t = np.zeros(2, dtype=int)
+    if flip_horizontal:
+        M[0, 0], t[0] = -1, w - 1
+    if flip_vertical:
+        M[1, 1], t[1] = -1, h - 1
+    if rotate_90:
+        R = np.array([[0, 1], [-1, 0]])
+        M, t = R @ M, R @ t + np.array([0, w - 1])
+    return M, t
 
-        point_names = list(st.session_state.points.keys())
-        current_name = point_names[st.session_state.current_point]
+def inv_pt(p, M, t):
+    # Displayed -> original coordinates; M is a signed permutation so M.T == inv(M)
+    return tuple((M.T @ (np.asarray(p) - t)).tolist())
 
-        # Display image with current markings
-        fig, ax = plt.subplots(figsize=(10, 10))
-        ax.imshow(img_array)
-        
-        # Plot existing points
-        for name, point in st.session_state.points.items():
-            if point is not None:
-                # Transform points if image was flipped
-                x, y = point[0], point[1]
-                if flip_horizontal:
-                    x = width - x - 1
-                if flip_vertical:
-                    y = height - y - 1
-                if rotate_90:
-                    x, y = y, width - x - 1
-                ax.plot(x, y, 'ro')
-                ax.text(x, y, name.replace('_', ' '), color='yellow')
-        
-        st.pyplot(fig)
+def _oriented(file_bytes, orient):
+    flip_horizontal, flip_vertical, rotate_90 = orient
+    img_array = _decode(file_bytes)
+    if not any(orient):
+        return img_array
+    if flip_horizontal:
+        img_array = np.fliplr(img_array)
+    if flip_vertical:
+        img_array = np.flipud(img_array)
+    if rotate_90:
+        img_array = np.rot90(img_array)
+    return np.ascontiguousarray(img_array)
 
-        # Coordinate input
-        st.subheader(f"Mark {current_name.replace('_', ' ').title()}")
-        
+DISPLAY_MAX_SIDE = 1200
+GRID_SPACING = 150
+
+def _draw_grid(disp, scale, height, width):
+    # Pixel grid labelled in full-resolution coordinates, standing in for plot axes
+    raw = GRID_SPACING / scale
+    mag = 10 ** int(np.floor(np.log10(raw)))
+    step = next(m * mag for m in (1, 2, 5, 10) if m * mag >= raw)
+    grid = disp.copy()
+    rows, cols = grid.shape[0], grid.shape[1]
+    for v in range(0, width, step):
+        xd = int(round(v * scale))
+        cv2.line(grid, (xd, 0), (xd, rows - 1), (0, 255, 255), 1)
+        cv2.putText(grid, str(v), (xd + 2, 12), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
+    for v in range(0, height, step):
+        yd = int(round(v * scale))
+        cv2.line(grid, (0, yd), (cols - 1, yd), (0, 255, 255), 1)
+        cv2.putText(grid, str(v), (2, max(yd - 2, 24)), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
+    return grid
+
+@st.cache_data(max_entries=4)
+def _display(file_bytes, orient):
+    # Downsampled RGB copy of the oriented image, with grid, for the marking view
+    img_array = _oriented(file_bytes, orient)
+    height, width = img_array.shape[0], img_array.shape[1]
+    scale = min(1.0, DISPLAY_MAX_SIDE / max(height, width))
+    disp = img_array
+    # st.image expects 8-bit data; 16-bit and 32-bit X-rays are stretched to [0, 255]
+    if disp.dtype != np.uint8:
+        disp = cv2.normalize(disp, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    if scale < 1:
+        disp = cv2.resize(disp, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    if disp.ndim == 2:
+        disp = cv2.cvtColor(disp, cv2.COLOR_GRAY2RGB)
+    elif disp.shape[2] == 4:
+        disp = cv2.cvtColor(disp, cv2.COLOR_RGBA2RGB)
+    disp = _draw_grid(disp, scale, height, width)
+    return disp, scale, (height, width)
+
+@st.cache_data(max_entries=4)
+def _final_png(file_bytes, pts):
+    hcx, hcy = pts[HC]
+    fcx, fcy = pts[FC]
+    mcx, mcy = pts[MC]
+    lcx, lcy = pts[LC]
+    mtpx, mtpy = pts[MTP]
+    ltpx, ltpy = pts[LTP]
+    acx, acy = pts[AC]
+
+    import matplotlib.pyplot as plt
+
+    fig2, ax2 = plt.subplots(figsize=(10, 10))
+    ax2.imshow(_decode(file_bytes))
+    
+    # Plot all points
+    for name, point in zip(POINT_NAMES, pts):
+        ax2.plot(point[0], point[1], 'ro')
+        ax2.text(point[0], point[1], name.replace('_', ' '), color='yellow')
+    
+    # Draw measurement lines
+    ax2.plot([hcx, fcx], [hcy, fcy], 'b-', label='Mechanical Axis Femur')
+    ax2.plot([fcx, acx], [fcy, acy], 'b-', label='Mechanical Axis Tibia')
+    ax2.plot([mcx, lcx], [mcy, lcy], 'g-', label='Femoral Condyle Line')
+    ax2.plot([mtpx, ltpx], [mtpy, ltpy], 'r-', label='Tibial Plateau Line')
+    ax2.legend()
+
+    buf = BytesIO()
+    fig2.savefig(buf, format='png', dpi=100)
+    plt.close(fig2)
+    return buf.getvalue()
+
+@st.fragment
+def _marking_ui(file_bytes):
+    # Add image orientation controls
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        flip_horizontal = st.checkbox("Flip Horizontal (Mirror)")
+    with col2:
+        flip_vertical = st.checkbox("Flip Vertical (Upside Down)")
+    with col3:
+        rotate_90 = st.checkbox("Rotate 90°")
+    
+    # Apply transformations
+    orient = (flip_horizontal, flip_vertical, rotate_90)
+    disp, scale, (height, width) = _display(file_bytes, orient)
+    
+    # Dimensions of the original (un-oriented) image
+    h, w = (width, height) if rotate_90 else (height, width)
+    M, t = build_affine(flip_horizontal, flip_vertical, rotate_90, w, h)
+    
+    pts, mask = st.session_state.pts, st.session_state.mask
+    current_name = POINT_NAMES[st.session_state.current_point]
+
+    # Display image with current markings
+    overlay = disp.copy()
+    
+    # Plot existing points (transformed into the displayed orientation)
+    if mask.any():
+        shown = np.einsum('ij,nj->ni', M, pts[mask]) + t
+        # Markers are placed on the downsampled display copy
+        shown = shown * scale
+        names = [name for name, m in zip(POINT_NAMES, mask) if m]
+        for name, (x, y) in zip(names, shown):
+            cv2.circle(overlay, (int(x), int(y)), 6, (255, 0, 0), -1)
+            cv2.putText(overlay, name.replace('_', ' '), (int(x) + 8, int(y) - 8),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 1)
+    
+    st.image(overlay, channels="RGB")
+    if scale < 1:
+        st.caption(f"Shown at {scale:.0%} of {width}×{height} px; grid labels and "
+                   "coordinates below are full-resolution pixels")
+
+    # Coordinate input
+    st.subheader(f"Mark {current_name.replace('_', ' ').title()}")
+    
+    # Inputs are batched in a form so typing coordinates does not rerun
+    is_hip = current_name == 'hip_center'
+    if is_hip:
+        st.warning("For hip center: Mark 3+ points around femoral head circumference")
+    with st.form(f"mark_{current_name}"):
         col1, col2 = st.columns(2)
         x = col1.number_input(f"X coordinate (0-{width})", 
                             min_value=0, max_value=width, 
@@ -91,62 +178,88 @@ def main():
         y = col2.number_input(f"Y coordinate (0-{height})", 
                              min_value=0, max_value=height, 
                              value=height//2, key=f"{current_name}_y")
+        # Enter submits via the first button, so on the hip step that must add a
+        # circumference point rather than save it as the centre
+        add_hip = is_hip and st.form_submit_button("Add Hip Point")
+        save = st.form_submit_button(f"Save {current_name.replace('_', ' ')}")
 
-        if st.button(f"Save {current_name.replace('_', ' ')}"):
-            # Save original coordinates (before flipping)
-            if flip_horizontal:
-                x = width - x - 1
-            if flip_vertical:
-                y = height - y - 1
-            if rotate_90:
-                x, y = height - y - 1, x
-            st.session_state.points[current_name] = (x, y)
-            st.session_state.current_point += 1
-            st.experimental_rerun()
-
-        # Special handling for hip center (circle fitting)
-        if current_name == 'hip_center':
-            st.warning("For hip center: Mark 3+ points around femoral head circumference")
-            if st.button("Add Hip Point"):
-                if 'hip_points' not in st.session_state:
-                    st.session_state.hip_points = []
-                # Save original coordinates
-                x_orig, y_orig = x, y
-                if flip_horizontal:
-                    x_orig = width - x_orig - 1
-                if flip_vertical:
-                    y_orig = height - y_orig - 1
-                if rotate_90:
-                    x_orig, y_orig = height - y_orig - 1, x_orig
-                st.session_state.hip_points.append((x_orig, y_orig))
-                st.experimental_rerun()
-                
-            if 'hip_points' in st.session_state and len(st.session_state.hip_points) >= 3:
-                if st.button("Calculate Hip Center"):
-                    points = np.array(st.session_state.hip_points)
-                    A = np.column_stack([2*points, np.ones(len(points))])
-                    b = (points[:, 0]**2 + points[:, 1]**2)
-                    center_x, center_y, _ = np.linalg.lstsq(A, b, rcond=None)[0]
-                    st.session_state.points['hip_center'] = (center_x, center_y)
+    if save:
+        # Save original coordinates (before flipping)
+        idx = st.session_state.current_point
+        pts[idx] = inv_pt((x, y), M, t)
+        mask[idx] = True
+        st.session_state.current_point += 1
+        st.rerun()
+
+    # Special handling for hip center (circle fitting)
+    if is_hip:
+        if add_hip:
+            if 'hip_points' not in st.session_state:
+                st.session_state.hip_points = []
+            # Save original coordinates
+            st.session_state.hip_points.append(inv_pt((x, y), M, t))
+        st.caption(f"Hip points added: {len(st.session_state.get('hip_points', []))}")
+            
+        if 'hip_points' in st.session_state and len(st.session_state.hip_points) >= 3:
+            if st.button("Calculate Hip Center"):
+                hip = np.array(st.session_state.hip_points, dtype=float)
+                # Kåsa fit via its normal equations, on mean-centred points so the
+                # system does not degrade with distance from the image origin
+                mean = hip.mean(axis=0)
+                uv = hip - mean
+                sv = np.linalg.svd(uv, compute_uv=False)
+                if sv[0] == 0 or sv[-1] < 1e-3 * sv[0]:
+                    st.error("Hip points are collinear or duplicated; add distinct points on the femoral head")
+                else:
+                    # Centring makes Sx = Sy = 0, leaving a 2x2 system for the centre
+                    hx, hy = uv[:, 0], uv[:, 1]
+                    r2 = hx*hx + hy*hy
+                    Sxx, Syy, Sxy = (hx*hx).sum(), (hy*hy).sum(), (hx*hy).sum()
+                    A = np.array([[2*Sxx, 2*Sxy],
+                                  [2*Sxy, 2*Syy]])
+                    rhs = np.array([(hx*r2).sum(), (hy*r2).sum()])
+                    center_x, center_y = np.linalg.solve(A, rhs) + mean
+                    pts[HC] = (center_x, center_y)
+                    mask[HC] = True
                     st.session_state.current_point += 1
-                    st.experimental_rerun()
+                    st.rerun()
+
+def main():
+    st.title("📐 X-ray Angle Measurement Tool")
+    st.write("Upload a full-length lower limb X-ray to measure orthopedic angles")
+
+    uploaded_file = st.file_uploader("Choose an X-ray image...", type=["jpg", "jpeg", "png"])
+
+    if uploaded_file is not None:
+        file_bytes = uploaded_file.getvalue()
+        
+        if 'pts' not in st.session_state:
+            st.session_state.pts = np.full((len(POINT_NAMES), 2), np.nan, dtype=np.float32)
+            st.session_state.mask = np.zeros(len(POINT_NAMES), dtype=bool)
+            st.session_state.current_point = 0
+
+        pts, mask = st.session_state.pts, st.session_state.mask
+
+        # Marking runs as a fragment so its widgets rerun only this section
+        if not mask.all():
+            _marking_ui(file_bytes)
 
         # Calculate angles when all points are marked
-        if all(p is not None for p in st.session_state.points.values()):
-            hc = np.array(st.session_state.points['hip_center'])
-            fc = np.array(st.session_state.points['femoral_condyles_center'])
-            mc = np.array(st.session_state.points['medial_condyle'])
-            lc = np.array(st.session_state.points['lateral_condyle'])
-            mtp = np.array(st.session_state.points['medial_tibial_plateau'])
-            ltp = np.array(st.session_state.points['lateral_tibial_plateau'])
-            tc = np.array(st.session_state.points['tibia_center'])
-            ac = np.array(st.session_state.points['ankle_center'])
+        if mask.all():
+            hcx, hcy = pts[HC]
+            fcx, fcy = pts[FC]
+            mcx, mcy = pts[MC]
+            lcx, lcy = pts[LC]
+            mtpx, mtpy = pts[MTP]
+            ltpx, ltpy = pts[LTP]
+            tcx, tcy = pts[TC]
+            acx, acy = pts[AC]
 
             # Calculate angles
-            hka = angle_between_lines(hc, fc, ac, fc)
-            jlca = angle_between_lines(mc, lc, mtp, ltp)
-            ldafa = angle_between_lines(hc, fc, mc, lc)
-            mpta = angle_between_lines(ac, tc, mtp, ltp)
+            hka = angle_between_lines(hcx, hcy, fcx, fcy, acx, acy, fcx, fcy)
+            jlca = angle_between_lines(mcx, mcy, lcx, lcy, mtpx, mtpy, ltpx, ltpy)
+            ldafa = angle_between_lines(hcx, hcy, fcx, fcy, mcx, mcy, lcx, lcy)
+            mpta = angle_between_lines(acx, acy, tcx, tcy, mtpx, mtpy, ltpx, ltpy)
 
             # Display results
             st.success("Measurement Complete!")
@@ -157,25 +270,11 @@ def main():
             col2.metric("MPTA (Medial Proximal Tibial)", f"{mpta:.1f}°")
 
             # Draw final plot (on original image)
-            fig2, ax2 = plt.subplots(figsize=(10, 10))
-            ax2.imshow(st.session_state.original_image)
-            
-            # Plot all points
-            for name, point in st.session_state.points.items():
-                ax2.plot(point[0], point[1], 'ro')
-                ax2.text(point[0], point[1], name.replace('_', ' '), color='yellow')
-            
-            # Draw measurement lines
-            ax2.plot([hc[0], fc[0]], [hc[1], fc[1]], 'b-', label='Mechanical Axis Femur')
-            ax2.plot([fc[0], ac[0]], [fc[1], ac[1]], 'b-', label='Mechanical Axis Tibia')
-            ax2.plot([mc[0], lc[0]], [mc[1], lc[1]], 'g-', label='Femoral Condyle Line')
-            ax2.plot([mtp[0], ltp[0]], [mtp[1], ltp[1]], 'r-', label='Tibial Plateau Line')
-            ax2.legend()
-            st.pyplot(fig2)
+            st.image(_final_png(file_bytes, pts))
 
             if st.button("Start New Measurement"):
                 st.session_state.clear()
-                st.experimental_rerun()
+                st.rerun()
 
 if __name__ == "__main__":
     main()